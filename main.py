@@ -1,22 +1,79 @@
 import os
+import json
+import asyncio
+import logging
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from bson import ObjectId
+from pymongo.errors import ConnectionFailure
+from pymongo.write_concern import WriteConcern
+from cachetools import TTLCache
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_documents, get_documents
 from schemas import Product, Order
 
-app = FastAPI(title="Lingerie Store API")
+app = FastAPI(title="Lingerie Store API", default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
+
+# Comma-separated list of allowed frontend origins, e.g. "https://shop.example.com"
+cors_origins = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=cors_origins,
+    allow_credentials=False,  # the API doesn't use cookies
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflight responses for a day
 )
+# Product listings are JSON-heavy and compress well; tiny responses aren't worth it
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Totals and facets per filter combination; a minute of staleness is fine for browsing
+SEARCH_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=60)
+# JSON-ready product documents by id
+PRODUCT_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# What a product grid card needs; full documents come from GET /api/products/{id}
+SEARCH_ITEM_FIELDS: Dict[str, Any] = {
+    "title": 1,
+    "price": 1,
+    "compare_at_price": 1,
+    "rating": 1,
+    "category": 1,
+    "images": {"$slice": ["$images", 1]},
+}
+
+# Slim copy of the catalog holding only the fields facet queries need
+FACETS_COLLECTION = "product_facets"
+FACETS_REFRESH_SECONDS = int(os.getenv("FACETS_REFRESH_SECONDS", 300))
+
+# Compound product indexes; trailing _id matches the keyset tie-breaker used for pagination
+CATEGORY_PRICE_INDEX = [("is_active", 1), ("category", 1), ("price", 1), ("_id", 1)]
+CATEGORY_RATING_INDEX = [("is_active", 1), ("category", 1), ("rating", -1), ("_id", -1)]
+SUBCATEGORY_PRICE_INDEX = [("is_active", 1), ("subcategory", 1), ("price", 1), ("_id", 1)]
+# Optional sort fields (Product.rating); missing/null values sort after every real value when descending
+NULLABLE_SORT_FIELDS = {"rating"}
+
+PRODUCT_INDEXES = [
+    CATEGORY_PRICE_INDEX,
+    CATEGORY_RATING_INDEX,
+    SUBCATEGORY_PRICE_INDEX,
+    # Multikey indexes for the array filters
+    [("variants.color", 1)],
+    [("variants.size", 1)],
+    [("tags", 1)],
+    [("title", "text"), ("description", "text")],
+]
+# $out keeps the target's indexes across refreshes
+FACETS_INDEXES = [
+    [("is_active", 1), ("category", 1), ("price", 1)],
+    [("is_active", 1), ("subcategory", 1), ("price", 1)],
+]
 
 
 class FilterRequest(BaseModel):
@@ -29,8 +86,109 @@ class FilterRequest(BaseModel):
     tags: Optional[List[str]] = None
     sort: Optional[str] = None  # 'price_asc', 'price_desc', 'rating'
     search: Optional[str] = None
-    page: int = 1
-    limit: int = 24
+    page: int = Field(1, ge=1)
+    limit: int = Field(24, ge=1)  # $limit must be positive
+    # Keyset cursor from a previous response's `next_cursor`; takes precedence over `page`
+    after_value: Optional[float] = None
+    after_id: Optional[str] = None
+    # Facets only change with the filters; clients can skip them when paging
+    include_facets: bool = True
+
+
+# (collection, key spec) pairs known to exist; search only hints these
+_ready_indexes = set()
+
+
+async def ensure_indexes():
+    """Create any missing search indexes, each on its own so one conflict doesn't skip the rest"""
+    for collection_name, specs in (("product", PRODUCT_INDEXES), (FACETS_COLLECTION, FACETS_INDEXES)):
+        for spec in specs:
+            key = (collection_name, tuple(spec))
+            if key in _ready_indexes:
+                continue
+            try:
+                await db[collection_name].create_index(spec)
+                _ready_indexes.add(key)
+            except ConnectionFailure as e:
+                # Database unreachable; the periodic refresh tries again later
+                logger.warning("Creating indexes failed: %s", e)
+                return
+            except Exception as e:
+                logger.warning("Creating index %s on %s failed: %s", spec, collection_name, e)
+
+
+@app.on_event("startup")
+async def create_indexes():
+    """Create indexes matching the search query shapes (Equality, Sort, Range)"""
+    if db is None:
+        return
+    # A database problem shouldn't stop the API from booting; /test reports it
+    await ensure_indexes()
+
+
+# Serializes $out rewrites between the periodic and seed-triggered refreshes
+_facets_lock = asyncio.Lock()
+# Strong references so fire-and-forget refreshes aren't garbage collected mid-run
+_background_tasks = set()
+# Bumped by every facet rebuild; searches that straddle one don't cache what they read
+_facets_generation = 0
+
+
+async def refresh_product_facets():
+    """Rebuild the slim facet collection and drop facets cached from the old copy"""
+    global _facets_generation
+    async with _facets_lock:
+        await db["product"].aggregate([
+            {"$project": {
+                "category": 1,
+                "subcategory": 1,
+                "tags": 1,
+                "variants.color": 1,
+                "variants.size": 1,
+                "is_active": 1,
+                "price": 1,
+            }},
+            {"$out": FACETS_COLLECTION},
+        ]).to_list(length=None)
+        _facets_generation += 1
+        SEARCH_CACHE.clear()
+
+
+async def _refresh_facets_logged():
+    try:
+        await refresh_product_facets()
+    except Exception as e:
+        logger.warning("Refreshing %s failed: %s", FACETS_COLLECTION, e)
+
+
+async def _refresh_facets_periodically():
+    while True:
+        await asyncio.sleep(FACETS_REFRESH_SECONDS)
+        await ensure_indexes()
+        await _refresh_facets_logged()
+
+
+@app.on_event("startup")
+async def start_facets_refresh():
+    if db is None:
+        return
+    # Build once before serving so early searches never facet an empty collection
+    await _refresh_facets_logged()
+    app.state.facets_task = asyncio.create_task(_refresh_facets_periodically())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Stop refreshes first so an in-flight $out doesn't hit a closed client
+    tasks = list(_background_tasks)
+    task = getattr(app.state, "facets_task", None)
+    if task is not None:
+        tasks.append(task)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if db is not None:
+        db.client.close()
 
 
 @app.get("/")
@@ -44,7 +202,7 @@ def get_schema():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -61,7 +219,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -79,19 +237,23 @@ def test_database():
 
 
 @app.post("/api/products/seed")
-def seed_products(products: List[Product]):
+async def seed_products(products: List[Product]):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
-    inserted_ids = []
-    for prod in products:
-        inserted_id = create_document("product", prod)
-        inserted_ids.append(inserted_id)
+    # Null fields (e.g. an unset rating) are omitted from the stored document, not stored as null
+    docs = [p.model_dump(mode="json", by_alias=True, exclude_none=True) for p in products]
+    # Catalog seeds can be replayed, so acking on the primary is enough
+    inserted_ids = await create_documents("product", docs, write_concern=WriteConcern(w=1, j=False))
+    # The $out rewrite covers the whole catalog, so don't hold the response on it
+    task = asyncio.create_task(_refresh_facets_logged())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
     return {"inserted": len(inserted_ids), "ids": inserted_ids}
 
 
 @app.post("/api/products/search")
-def search_products(filters: FilterRequest):
+async def search_products(filters: FilterRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
 
@@ -108,10 +270,7 @@ def search_products(filters: FilterRequest):
     if filters.tags:
         query["tags"] = {"$in": filters.tags}
     if filters.search:
-        query["$or"] = [
-            {"title": {"$regex": filters.search, "$options": "i"}},
-            {"description": {"$regex": filters.search, "$options": "i"}},
-        ]
+        query["$text"] = {"$search": filters.search}
 
     price_filter = {}
     if filters.price_min is not None:
@@ -121,54 +280,147 @@ def search_products(filters: FilterRequest):
     if price_filter:
         query["price"] = price_filter
 
-    sort_spec = None
+    sort_field = None
+    sort_dir = 1
     if filters.sort == "price_asc":
-        sort_spec = [("price", 1)]
+        sort_field, sort_dir = "price", 1
     elif filters.sort == "price_desc":
-        sort_spec = [("price", -1)]
+        sort_field, sort_dir = "price", -1
     elif filters.sort == "rating":
-        sort_spec = [("rating", -1)]
+        sort_field, sort_dir = "rating", -1
+
+    # Keyset pagination: order by (sort_field, _id) so the last item of a page
+    # identifies where the next one starts. Relevance-ranked search falls back
+    # to skip/limit since textScore cannot be used as a range bound.
+    keyset = not (filters.search and sort_field is None)
+    if keyset:
+        sort_spec = {sort_field: sort_dir, "_id": sort_dir} if sort_field else {"_id": 1}
+    else:
+        # _id breaks score ties so $skip pages don't repeat or drop items
+        sort_spec = {"score": {"$meta": "textScore"}, "_id": 1}
+
+    page_query = query
+    use_cursor = bool(keyset and filters.after_id)
+    if use_cursor:
+        try:
+            after_id = ObjectId(filters.after_id)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid after_id")
+        op = "$gt" if sort_dir == 1 else "$lt"
+        if sort_field and filters.after_value is None:
+            if sort_field not in NULLABLE_SORT_FIELDS:
+                raise HTTPException(status_code=400, detail="after_value is required with after_id for this sort")
+            # The previous page ended inside the trailing run of null values
+            keyset_filter = {sort_field: None, "_id": {op: after_id}}
+        elif sort_field:
+            keyset_filter = {"$or": [
+                {sort_field: {op: filters.after_value}},
+                {sort_field: filters.after_value, "_id": {op: after_id}},
+            ]}
+            if sort_dir == -1 and sort_field in NULLABLE_SORT_FIELDS:
+                keyset_filter["$or"].append({sort_field: None})
+        else:
+            keyset_filter = {"_id": {op: after_id}}
+        page_query = {**query, "$and": [keyset_filter]}
+
+    # Pin the compound index whose prefix matches the filter and sort, so the
+    # planner can't settle on a multikey index and sort in memory.
+    # $text queries can't be hinted; other shapes are left to the planner.
+    hint = None
+    if not filters.search:
+        if filters.category and sort_field == "price":
+            hint = CATEGORY_PRICE_INDEX
+        elif filters.category and sort_field == "rating":
+            hint = CATEGORY_RATING_INDEX
+        elif filters.subcategory and sort_field == "price":
+            hint = SUBCATEGORY_PRICE_INDEX
+    if hint and ("product", tuple(hint)) not in _ready_indexes:
+        hint = None  # not created (yet); hinting a missing index fails the query
 
     collection = db["product"]
-    skip = max(0, (filters.page - 1) * filters.limit)
-
-    total = collection.count_documents(query)
-    cursor = collection.find(query)
-    if sort_spec:
-        cursor = cursor.sort(sort_spec)
-    items = list(cursor.skip(skip).limit(filters.limit))
-
-    for item in items:
-        item["_id"] = str(item["_id"])  # make JSON serializable
 
-    # Build facet info for filters
-    color_counts = collection.aggregate([
-        {"$match": query},
-        {"$unwind": "$variants"},
-        {"$group": {"_id": "$variants.color", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ])
-    size_counts = collection.aggregate([
+    # aggregate() passes hint through as-is, so send the key spec as an ordered document
+    hint_options: Dict[str, Any] = {"hint": dict(hint)} if hint else {}
+
+    items_pipeline: List[Dict[str, Any]] = [{"$match": page_query}, {"$sort": sort_spec}]
+    if not use_cursor:
+        items_pipeline.append({"$skip": max(0, (filters.page - 1) * filters.limit)})
+    items_pipeline.append({"$limit": filters.limit})
+    # Per-item enrichment goes after $limit so it only touches returned documents;
+    # the total comes from count_documents, which never runs these stages.
+    # Stringify _id server-side so items are JSON-ready as they arrive
+    fields: Dict[str, Any] = {**SEARCH_ITEM_FIELDS, "_id": {"$toString": "$_id"}}
+    if filters.search:
+        fields["score"] = {"$meta": "textScore"}
+    items_pipeline.append({"$project": fields})
+    cursor = collection.aggregate(items_pipeline, **hint_options)
+
+    # Build facet info for filters; $match stays first so it can use indexes.
+    # The slim facet collection has no text index, so text searches use the catalog.
+    facet_source = collection if filters.search else db[FACETS_COLLECTION]
+    facet_pipeline = [
         {"$match": query},
         {"$unwind": "$variants"},
-        {"$group": {"_id": "$variants.size", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ])
+        {"$facet": {
+            "colors": [
+                {"$group": {"_id": "$variants.color", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}}
+            ],
+            "sizes": [
+                {"$group": {"_id": "$variants.size", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}}
+            ],
+        }},
+    ]
+
+    # Totals and facets are cached separately so the no-facets paging path reuses totals too
+    cache_key = json.dumps(query, sort_keys=True, default=str)
+    total = SEARCH_CACHE.get(("total", cache_key))
+    facets = SEARCH_CACHE.get(("facets", cache_key)) if filters.include_facets else None
+    generation = _facets_generation
+
+    # Independent round-trips, so let them overlap on the event loop
+    pending = {"items": cursor.to_list(length=filters.limit)}
+    if total is None:
+        pending["total"] = collection.count_documents(query, **hint_options)
+    if filters.include_facets and facets is None:
+        pending["facets"] = facet_source.aggregate(facet_pipeline).to_list(length=1)
+    results = dict(zip(pending, await asyncio.gather(*pending.values())))
+
+    items = results["items"]
+    fresh = generation == _facets_generation
+    if "total" in results:
+        total = results["total"]
+        if fresh:
+            SEARCH_CACHE[("total", cache_key)] = total
+    if "facets" in results:
+        facets = results["facets"][0]
+        if fresh:
+            SEARCH_CACHE[("facets", cache_key)] = facets
+
+    next_cursor = None
+    if keyset and len(items) == filters.limit:
+        last = items[-1]
+        next_cursor = {
+            "after_value": last.get(sort_field) if sort_field else None,
+            "after_id": last["_id"],
+        }
 
     return {
         "total": total,
-        "page": filters.page,
+        "page": None if use_cursor else filters.page,
         "limit": filters.limit,
+        "next_cursor": next_cursor,
         "items": items,
         "facets": {
-            "colors": [{"value": c["_id"], "count": c["count"]} for c in color_counts if c.get("_id")],
-            "sizes": [{"value": s["_id"], "count": s["count"]} for s in size_counts if s.get("_id")],
-        }
+            "colors": [{"value": c["_id"], "count": c["count"]} for c in facets["colors"] if c.get("_id")],
+            "sizes": [{"value": s["_id"], "count": s["count"]} for s in facets["sizes"] if s.get("_id")],
+        } if filters.include_facets else None
     }
 
 
 @app.get("/api/products/{product_id}")
-def get_product(product_id: str):
+async def get_product(product_id: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
     try:
@@ -176,18 +428,21 @@ def get_product(product_id: str):
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid product id")
 
-    doc = db["product"].find_one({"_id": obj_id})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Not found")
-    doc["_id"] = str(doc["_id"])
+    doc = PRODUCT_CACHE.get(product_id)
+    if doc is None:
+        doc = await db["product"].find_one({"_id": obj_id})
+        if not doc:
+            raise HTTPException(status_code=404, detail="Not found")
+        doc["_id"] = str(doc["_id"])
+        PRODUCT_CACHE[product_id] = doc
     return doc
 
 
 @app.post("/api/orders")
-def create_order(order: Order):
+async def create_order(order: Order):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    order_id = create_document("order", order)
+    order_id = await create_document("order", order)
     return {"order_id": order_id}
 
 